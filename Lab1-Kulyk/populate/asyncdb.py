@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from db import Db, DbOperation
+
+
+class DbPool:
+    def __init__(self, auth, retries, size, backoff_base=0.5, backoff_max=30.0):
+        self.dbs = [Db(auth, retries, backoff_base, backoff_max) for _ in range(size)]
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db-pool")
+        self.loop = None
+        self.free = None
+
+    def get_free(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.free = asyncio.Queue()
+            for db in self.dbs:
+                self.free.put_nowait(db)
+        return self.free
+
+    async def run(self, operation):
+        free = self.get_free()
+        db = await free.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, DbPool.call, db, operation)
+        finally:
+            free.put_nowait(db)
+
+    @staticmethod
+    def call(db, operation):
+        if db.conn is None:
+            db.connect()
+        result = operation(DbOperation(db))
+        db.commit()
+        return result
+
+    def close(self):
+        self.executor.shutdown()
+        for db in self.dbs:
+            if db.conn is not None and not db.conn.closed:
+                db.disconnect()
+
+
+class AsyncDbOperation:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def transaction(self, operation):
+        return await self.pool.run(operation)
+
+    async def fetchall(self, name, command, data):
+        return await self.pool.run(lambda op: op.fetchall(name, command, data))
+
+    async def fetchone(self, name, command, data):
+        return await self.pool.run(lambda op: op.fetchone(name, command, data))
+
+    async def execute(self, name, command, data):
+        await self.pool.run(lambda op: op.execute(name, command, data))
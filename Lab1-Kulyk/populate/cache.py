@@ -0,0 +1,86 @@
+import json
+
+from user import get_env_default
+
+
+class ResultCache:
+    def __init__(self, cache_table_name, manifest_table_name, max_entries=256):
+        self.cache_table_name = cache_table_name
+        self.manifest_table_name = manifest_table_name
+        self.max_entries = max_entries
+        self.enabled = max_entries > 0
+
+    @staticmethod
+    def key(report, params, year):
+        return json.dumps(dict(params, report=report, year=year), sort_keys=True, ensure_ascii=False)
+
+    def ensure_tables(self, op):
+        if not op.check_table_exists(self.manifest_table_name, "CHECK EXISTS MANIFEST TABLE"):
+            op.create_table(self.manifest_table_name, {
+                "year": "SMALLINT PRIMARY KEY",
+                "version": "BIGINT NOT NULL DEFAULT 0",
+                "loading": "BOOLEAN NOT NULL DEFAULT FALSE",
+            }, "CREATE MANIFEST TABLE")
+        if not op.check_table_exists(self.cache_table_name, "CHECK EXISTS CACHE TABLE"):
+            op.create_table(self.cache_table_name, {
+                "cache_key": "TEXT PRIMARY KEY",
+                "year": "SMALLINT",
+                "version": "BIGINT",
+                "result": "TEXT",
+                "last_used": "TIMESTAMP NOT NULL DEFAULT now()",
+            }, "CREATE CACHE TABLE")
+
+    def mark_loading(self, op, years):
+        self.ensure_tables(op)
+        op.execute_batch("MARK MANIFEST YEAR LOADING",
+                         f'INSERT INTO "{self.manifest_table_name}" (year, loading) VALUES (%s, TRUE) '
+                         f'ON CONFLICT (year) DO UPDATE SET loading = TRUE',
+                         [(year,) for year in years])
+
+    def mark_loaded(self, op):
+        if not op.check_table_exists(self.manifest_table_name, "CHECK EXISTS MANIFEST TABLE"):
+            return
+        op.execute("MARK MANIFEST YEARS LOADED",
+                   f'UPDATE "{self.manifest_table_name}" SET loading = FALSE, version = version + 1 '
+                   f'WHERE loading', ())
+
+    def lookup(self, op, key, year):
+        if not self.enabled:
+            return None, None
+        entry = op.fetchone("SELECT MANIFEST YEAR",
+                            f'SELECT version, loading FROM "{self.manifest_table_name}" WHERE year = %s',
+                            (year,))
+        version, loading = entry if entry is not None else (0, False)
+        if loading:
+            return None, None
+        cached = op.fetchone("TOUCH CACHED RESULT",
+                             f'UPDATE "{self.cache_table_name}" SET last_used = clock_timestamp() '
+                             f'WHERE cache_key = %s AND version = %s RETURNING result',
+                             (key, version))
+        if cached is None:
+            return version, None
+        return version, json.loads(cached[0])
+
+    def store(self, op, key, year, version, rows):
+        if not self.enabled or version is None:
+            return
+        op.execute("STORE CACHED RESULT",
+                   f'INSERT INTO "{self.cache_table_name}" (cache_key, year, version, result, last_used) '
+                   f'VALUES (%s, %s, %s, %s, clock_timestamp()) ON CONFLICT (cache_key) '
+                   f'DO UPDATE SET year = EXCLUDED.year, version = EXCLUDED.version, '
+                   f'result = EXCLUDED.result, last_used = EXCLUDED.last_used',
+                   (key, year, version, json.dumps(rows, ensure_ascii=False, default=str)))
+        op.execute("EVICT CACHED RESULTS",
+                   f'DELETE FROM "{self.cache_table_name}" WHERE cache_key IN '
+                   f'(SELECT cache_key FROM "{self.cache_table_name}" ORDER BY last_used DESC OFFSET %s)',
+                   (self.max_entries,))
+
+    def drop(self, op):
+        op.drop_table_if_exists(self.cache_table_name, "DROP CACHE TABLE")
+        op.drop_table_if_exists(self.manifest_table_name, "DROP MANIFEST TABLE")
+
+
+def load_cache(target_table_name):
+    return ResultCache(get_env_default("CACHE_TABLE_NAME", f"{target_table_name}_CACHE"),
+                       get_env_default("MANIFEST_TABLE_NAME", f"{target_table_name}_MANIFEST"),
+                       int(get_env_default("CACHE_MAX_ENTRIES", 256)))
@@ -1,30 +1,82 @@
+import bz2
+import gzip
+import io
+import json
+import lzma
+import mmap
 import os
 
 DATA_FOLDER = "data"
 SCHEMA_FILE = "SCHEMA.csv"
+STATS_FILE = "STATS.json"
 ENCODINGS = ["utf-8-sig", "cp1251", "utf-8"]
+COMPRESSIONS = {".gz": gzip, ".xz": lzma, ".bz2": bz2}
+READ_BUFFER_SIZE = 1 << 20
+
+
+class DataFile:
+    def __init__(self, path, encoding=None):
+        self.path = path
+        self.encoding = encoding
+        self.raw = None
+        self.stream = None
+        self.text = None
+        self.mapped = False
+
+    def __enter__(self):
+        self.raw = open(self.path, "rb")
+        compression = COMPRESSIONS.get(split_compression(self.path)[1])
+        if compression is not None:
+            self.stream = io.BufferedReader(compression.open(self.raw, "rb"), READ_BUFFER_SIZE)
+        elif self.encoding is None and os.fstat(self.raw.fileno()).st_size > 0:
+            self.stream = mmap.mmap(self.raw.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped = True
+        else:
+            self.stream = self.raw
+        if self.encoding is not None:
+            self.text = io.TextIOWrapper(self.stream, encoding=self.encoding)
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        if self.text is not None:
+            self.text.close()
+        self.stream.close()
+        self.raw.close()
+
+    def raw_tell(self):
+        if self.mapped:
+            return self.stream.tell()
+        return self.raw.tell()
+
+
+def split_compression(path):
+    base, ext = os.path.splitext(path)
+    if ext.lower() in COMPRESSIONS:
+        return base, ext.lower()
+    return path, ""
 
 
-def read_file(path):
-    b_enc, path_enc = os.path.splitext(os.path.splitext(path)[0])
+def read_file(path, consume):
+    base, comp_ext = split_compression(path)
+    b_enc, path_enc = os.path.splitext(os.path.splitext(base)[0])
     path_enc = path_enc[1:]
     guess_encodings = ENCODINGS
     if path_enc in ENCODINGS:
         guess_encodings = [path_enc] + [enc for enc in ENCODINGS if enc != path_enc]
     for encoding in guess_encodings:
         try:
-            with open(path, "r", encoding=encoding) as f:
-                lines = f.readlines()
+            with DataFile(path, encoding) as f:
+                result = consume(f)
             if encoding != path_enc:
-                os.rename(path, f"{b_enc}.{encoding}.csv")
-            return lines
+                os.rename(path, f"{b_enc}.{encoding}.csv{comp_ext}")
+            return result
         except UnicodeError as e:
             pass
     raise UnicodeError(f"Cannot decode file, tried encodings: {', '.join(ENCODINGS)}")
 
 
 def get_file_encoding(path):
-    return os.path.splitext(os.path.splitext(path)[0])[1][1:]
+    return os.path.splitext(os.path.splitext(split_compression(path)[0])[0])[1][1:]
 
 
 def get_file_size(path):
@@ -60,8 +112,9 @@ def parse_year(filename):
 def get_datafiles_list(path):
     data_files, data_files_years = [], dict()
     for file in os.listdir(path):
-        if file.endswith(".csv") and file.upper() != SCHEMA_FILE.upper():
-            year = parse_year(os.path.splitext(os.path.splitext(file)[0])[0])
+        base = split_compression(file)[0]
+        if base.endswith(".csv") and base.upper() != SCHEMA_FILE.upper():
+            year = parse_year(os.path.splitext(os.path.splitext(base)[0])[0])
             if year is None:
                 data_files.append(os.path.join(path, file))
             else:
@@ -75,15 +128,21 @@ def save_schema(path, names, types):
         f.writelines([";".join(names), '\n', ";".join(types)])
 
 
+def save_stats(path, stats):
+    with open(os.path.join(path, STATS_FILE), "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False, indent=1)
+
+
 def check_schema(path):
     return os.path.exists(os.path.join(path, SCHEMA_FILE))
 
 
 def delete_schema(path):
-    try:
-        os.remove(os.path.join(path, SCHEMA_FILE))
-    except FileNotFoundError:
-        pass
+    for file in [SCHEMA_FILE, STATS_FILE]:
+        try:
+            os.remove(os.path.join(path, file))
+        except FileNotFoundError:
+            pass
 
 
 def load_schema(path):
@@ -1,7 +1,9 @@
+import random
 import psycopg2
 import psycopg2.extras
 from time import sleep
 
+from metrics import METRICS
 from user import panic, print_err, command_error, PANIC_DB_ERROR_OCCURRED, PANIC_DB_RETRIED_ERROR
 
 
@@ -15,9 +17,17 @@ def retry(name, onerror):
     return _retry
 
 
+class DbUnavailable(Exception):
+    pass
+
+
+def backoff_delay(attempt, base, cap):
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
 class DbOperation:
     @staticmethod
-    def retry_no_reconnect(_self, name, operation, retries, onerror):
+    def retry_no_reconnect(self, name, operation, retries, onerror):
         def wrapper(*args, **kwargs):
             failed = False
             for i in range(retries + 1):
@@ -26,7 +36,10 @@ class DbOperation:
                 try:
                     result = operation(*args, **kwargs)
                 except psycopg2.OperationalError as e:
-                    sleep(1)
+                    if self.db.fail_fast:
+                        raise DbUnavailable(f"Operation {name} failed: {e}")
+                    METRICS.count("retries")
+                    sleep(backoff_delay(i, self.db.backoff_base, self.db.backoff_max))
                     failed = True
                 except psycopg2.InterfaceError as e:
                     raise e
@@ -41,12 +54,17 @@ class DbOperation:
         return wrapper
 
     def retry_operation(self, name, operation, onerror):
-        while True:
+        for i in range(self.db.retries + 1):
             try:
                 return DbOperation.retry_no_reconnect(self, name, operation, self.db.retries, onerror)(self)
-            except psycopg2.InterfaceError:
+            except psycopg2.InterfaceError as e:
+                if self.db.fail_fast:
+                    raise DbUnavailable(f"Operation {name} failed: {e}")
                 print_err(f"Operation {name} failed due to InterfaceError, reconnecting to db...")
+                METRICS.count("reconnects")
+                sleep(backoff_delay(i, self.db.backoff_base, self.db.backoff_max))
                 self.connect()
+        panic(f"Unable to perform {name} ({self.db.retries} reconnects)! Exiting...", PANIC_DB_RETRIED_ERROR)
 
     def __init__(self, db):
         self.db = db
@@ -55,6 +73,16 @@ class DbOperation:
     def connect(self):
         self.db.conn = psycopg2.connect(**self.db.auth)
         self.db.curr = self.db.conn.cursor()
+        self.db.curr.execute('SELECT 1')
+        self.db.generation += 1
+
+    @retry("COMMIT", lambda e: panic(f"Error occurred during commit:\n{e}", PANIC_DB_ERROR_OCCURRED))
+    def commit(self):
+        self.db.conn.commit()
+
+    @retry("ROLLBACK", lambda e: panic(f"Error occurred during rollback:\n{e}", PANIC_DB_ERROR_OCCURRED))
+    def rollback(self):
+        self.db.conn.rollback()
 
     def fetchall(self, name, command, data):
         @retry(name, lambda e: command_error(name, e, command, data))
@@ -115,10 +143,18 @@ class DbOperation:
         self.execute(operation_name,
                      f'CREATE TABLE "{table_name}" ({table_schema_str})', ())
 
+    def add_column_if_not_exists(self, table_name, column_name, column_type, operation_name="ADD COLUMN"):
+        self.execute(operation_name,
+                     f'ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS {column_name} {column_type}', ())
+
     def drop_table(self, table_name, operation_name="DROP TABLE"):
         self.execute(operation_name,
                      f'DROP TABLE "{table_name}"', ())
 
+    def drop_table_if_exists(self, table_name, operation_name="DROP TABLE IF EXISTS"):
+        self.execute(operation_name,
+                     f'DROP TABLE IF EXISTS "{table_name}"', ())
+
     def insert_many_into_table(self, table_name, names, values, operation_name="INSERT MANY INTO TABLE"):
         val_format_str = ", ".join(["%s"] * len(names))
         names_str = ", ".join(map(str, names))
@@ -138,11 +174,15 @@ class DbOperation:
 
 
 class Db:
-    def __init__(self, auth, retries):
+    def __init__(self, auth, retries, backoff_base=0.5, backoff_max=30.0):
         self.auth = auth
         self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
         self.conn = None
         self.curr = None
+        self.generation = 0
+        self.fail_fast = False
 
     def connect(self):
         DbOperation(self).connect()
@@ -150,5 +190,37 @@ class Db:
     def disconnect(self):
         DbOperation(self).close()
 
+    def reset(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+
+    def is_healthy(self, connect_timeout=5):
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(**self.auth, connect_timeout=connect_timeout)
+                self.curr = self.conn.cursor()
+                self.generation += 1
+            self.curr.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
     def commit(self):
-        self.conn.commit()
+        DbOperation(self).commit()
+
+    def rollback(self):
+        DbOperation(self).rollback()
+
+
+class FailFast:
+    def __init__(self, db, enabled=True):
+        self.db = db
+        self.enabled = enabled
+
+    def __enter__(self):
+        self.db.fail_fast = self.enabled
+
+    def __exit__(self, exc_type, _exc_val, _exc_tb):
+        self.db.fail_fast = False
+        if exc_type is DbUnavailable:
+            self.db.reset()
@@ -1,8 +1,12 @@
 import string
 
-from datafiles import DATA_FOLDER, get_datafiles_list, read_file, \
-    check_schema, delete_schema, load_schema, save_schema, strip_arr
-from user import print_flush, ask_variants, ask_confirm
+from datafiles import DATA_FOLDER, get_datafiles_list, read_file, get_file_size, format_file_size, \
+    check_schema, delete_schema, load_schema, save_schema, save_stats, strip, strip_arr
+import metrics
+from metrics import METRICS
+from projection import load_projection
+from sketches import ColumnStats
+from user import get_env_default, print_flush, ask_variants, ask_confirm
 
 
 def main():
@@ -12,6 +16,8 @@ def main():
     while schema.handle_state():
         print_flush()
 
+    METRICS.dump()
+
     print_flush("\nSchema generation script stopped")
 
 
@@ -26,11 +32,13 @@ class SqlValueType:
     SQL_TYPE_VARCHAR = 3
 
     def __init__(self, sql_type=None, val=None):
+        self.num = None
         if val is None:
             self.sql_type = sql_type
             self.sql_len = 1
         else:
-            if SqlValueType.can_be_smallint(val):
+            self.num = SqlValueType.parse_smallint(val)
+            if self.num is not None:
                 self.sql_type = SqlValueType.SQL_TYPE_SMALLINT
             elif SqlValueType.can_be_uuid(val):
                 self.sql_type = SqlValueType.SQL_TYPE_UUID
@@ -39,12 +47,16 @@ class SqlValueType:
             self.sql_len = len(str(val))
 
     @staticmethod
-    def can_be_smallint(val):
+    def parse_smallint(val):
         try:
             num = int(val)
-            return -32768 <= num <= 32767
         except ValueError:
-            return False
+            return None
+        return num if -32768 <= num <= 32767 else None
+
+    @staticmethod
+    def can_be_smallint(val):
+        return SqlValueType.parse_smallint(val) is not None
 
     @staticmethod
     def can_be_uuid(val):
@@ -67,7 +79,10 @@ class SqlValueType:
 class Schema:
     def __init__(self, folder):
         self.folder = folder
+        self.projection = load_projection()
+        self.stats_top_k = int(get_env_default("STATS_TOP_K", 10))
         self.columns = default_columns()
+        self.stats = dict()
 
     def get_state(self):
         if check_schema(self.folder):
@@ -78,25 +93,60 @@ class Schema:
         else:
             return "clear"
 
+    def scan(self, data, progress):
+        file_size = get_file_size(data.path)
+        new_columns = []
+        projected = []
+        for ind, column_name in enumerate(strip_arr(data.text.readline().split(';'))):
+            if self.projection.matches(column_name):
+                new_columns.append((column_name, SqlValueType(sql_type=SqlValueType.SQL_TYPE_SMALLINT),
+                                    ColumnStats(self.stats_top_k)))
+                projected.append((ind, new_columns[-1][1], new_columns[-1][2]))
+        maxsplit = projected[-1][0] + 1 if projected else 0
+        j = 0
+        while True:
+            t = METRICS.clock()
+            line = data.text.readline()
+            METRICS.add_time("schema_read", t)
+            if not line:
+                break
+            if j % 1000 == 0:
+                print_flush(f"\r{progress}: processing rows... "
+                            f"({j} rows, {format_file_size(data.raw_tell())} / {format_file_size(file_size)})",
+                            end='')
+                METRICS.tick()
+            t = METRICS.clock()
+            new_vals = line.split(';', maxsplit)
+            METRICS.add_time("schema_tokenise", t)
+            t = METRICS.clock()
+            for ind, sql_type, stats in projected:
+                if ind >= len(new_vals):
+                    break
+                val = strip(new_vals[ind])
+                val_type = SqlValueType(None, val)
+                sql_type.fit(val_type)
+                stats.add(val, val_type.num)
+            METRICS.add_time("schema_infer", t)
+            j += 1
+        METRICS.count("schema_rows", j)
+        return new_columns
+
     def make(self):
         self.columns = default_columns()
+        self.stats = dict()
         data_files = get_datafiles_list(self.folder)
         for i, (file, year) in enumerate(data_files):
             year_str = f" ({year})" if year is not None else ""
             print_flush(f"Processing ({i+1}/{len(data_files)}) '{file}'{year_str}: reading file... ", end='')
-            lines = read_file(file)
-            new_columns = []
-            for column_name in strip_arr(lines[0].split(';')):
-                new_columns.append((column_name, SqlValueType(sql_type=SqlValueType.SQL_TYPE_SMALLINT)))
-            for j, line in enumerate(lines[1:]):
-                if j % 1000 == 0:
-                    print_flush(f"\rProcessing ({i+1}/{len(data_files)}) '{file}'{year_str}: processing rows... "
-                                f"({j}/{len(lines) - 1})", end='')
-                new_vals = strip_arr(line.split(';'))
-                for val, column in zip(new_vals, new_columns):
-                    column[1].fit(SqlValueType(None, val))
+            progress = f"Processing ({i+1}/{len(data_files)}) '{file}'{year_str}"
+            new_columns = read_file(file, lambda data: self.scan(data, progress))
             print_flush(f"\r\x1b[1K\rProcessing ({i+1}/{len(data_files)}) '{file}'{year_str}: combining... ", end='')
             for new_column in new_columns:
+                year_stats = self.stats.setdefault(new_column[0].upper(), dict())
+                if year in year_stats:
+                    year_stats[year].merge(new_column[2])
+                else:
+                    year_stats[year] = new_column[2]
                 found = False
                 for column in self.columns:
                     if new_column[0].upper() == column[0].upper():
@@ -104,7 +154,7 @@ class Schema:
                         found = True
                         break
                 if not found:
-                    self.columns.append(new_column)
+                    self.columns.append(new_column[:2])
             print_flush("done!")
         print_flush(f"Saving schema ({len(data_files)} files, {len(self.columns)} columns) "
                     f"to folder '{self.folder}'... ", end='')
@@ -114,9 +164,25 @@ class Schema:
             names_texts.append(column[0])
             types_texts.append(column[1].dump())
         save_schema(self.folder, names_texts, types_texts)
+        save_stats(self.folder, self.dump_stats())
         print_flush("done!")
         return False
 
+    def dump_stats(self):
+        dumped = dict()
+        for name, _ in self.columns:
+            year_stats = self.stats.get(name.upper())
+            if not year_stats:
+                continue
+            total = ColumnStats(self.stats_top_k)
+            for stats in year_stats.values():
+                total.merge(stats)
+            dumped[name] = {
+                "total": total.dump(),
+                "years": {str(year): stats.dump() for year, stats in year_stats.items()},
+            }
+        return dumped
+
     def handle_state(self):
         state = self.get_state()
         if state == "correct":
@@ -171,4 +237,5 @@ class Schema:
 
 
 if __name__ == "__main__":
+    metrics.setup()
     main()
@@ -1,3 +1,4 @@
+import metrics
 from populate import Populate
 from user import print_flush, use_env_files, ask_variants, ask_confirm
 
@@ -6,6 +7,7 @@ def main():
     print_flush("\n\n\n")
     print_flush("Populate script started\n")
     use_env_files()
+    metrics.setup()
 
     populate = Populate()
     with populate:
@@ -22,6 +24,7 @@ def handle_state(populate):
             sel = ask_variants("Schema is missing or corrupted.\n", {
                 "r": "reload state",
                 "g": "run genschema script",
+                "l": "start population inferring schema on load",
                 "e": "exit",
             })
             if sel == "r":
@@ -31,6 +34,38 @@ def handle_state(populate):
                 if populate.get_state() != state:
                     return True
                 return run_genschema(populate)
+            elif sel == "l":
+                reload(populate)
+                if populate.get_state() != state:
+                    return True
+                return start_staged(populate)
+            elif sel == "e":
+                return False
+            print_flush()
+    elif state == "staging":
+        while True:
+            sel = ask_variants("Looks like the population with schema inference was interrupted.\n", {
+                "r": "reload state",
+                "c": "continue population",
+                "d": "drop staged data",
+                "e": "exit",
+            })
+            if sel == "r":
+                return reload(populate)
+            elif sel == "c":
+                reload(populate)
+                if populate.get_state() != state:
+                    return True
+                return resume_staged(populate)
+            elif sel == "d":
+                reload(populate)
+                if populate.get_state() != state:
+                    return True
+                if ask_confirm():
+                    reload(populate)
+                    if populate.get_state() != state:
+                        return True
+                    return drop_staged(populate)
             elif sel == "e":
                 return False
             print_flush()
@@ -171,6 +206,26 @@ def resume(populate):
     return False
 
 
+def start_staged(populate):
+    populate.prepare_staged()
+    populate.start_staged()
+    populate.commit()
+    return False
+
+
+def resume_staged(populate):
+    populate.start_staged()
+    populate.commit()
+    return False
+
+
+def drop_staged(populate):
+    print_flush("Dropping...")
+    populate.drop_staged()
+    populate.commit()
+    return True
+
+
 def assume_finished(populate):
     clear_artifacts(populate)
     return True
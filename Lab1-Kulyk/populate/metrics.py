@@ -0,0 +1,199 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+from user import get_env_default
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.format = "prom"
+        self.interval = 5.0
+        self.timers = dict()
+        self.counters = dict()
+        self.started = time.perf_counter()
+        self.last_dump = self.started
+        self.active = 0.0
+        self.active_since = None
+
+    def configure(self, path, fmt="prom", interval=5.0):
+        self.enabled = bool(path)
+        self.path = path
+        self.format = fmt
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.last_dump = self.started
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def add_time(self, name, since):
+        if self.enabled:
+            self.timers[name] = self.timers.get(name, 0.0) + time.perf_counter() - since
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def activity(self):
+        if not self.enabled:
+            return NULL_STAGE
+        return Activity(self)
+
+    def active_time(self):
+        if self.active_since is None:
+            return self.active
+        return self.active + time.perf_counter() - self.active_since
+
+    def tick(self):
+        if self.enabled and time.perf_counter() - self.last_dump >= self.interval:
+            self.dump()
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.started
+        active = self.active_time()
+        rates = dict()
+        if active > 0:
+            rates["rows_per_second"] = self.counters.get("rows", 0) / active
+            rates["bytes_per_second"] = self.counters.get("bytes", 0) / active
+        return dict(time=time.time(),
+                    elapsed=elapsed,
+                    active=active,
+                    stages=dict(self.timers),
+                    counters=dict(self.counters),
+                    rates=rates)
+
+    def dump(self):
+        if not self.enabled:
+            return
+        self.last_dump = time.perf_counter()
+        snapshot = self.snapshot()
+        if self.format == "json":
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snapshot) + '\n')
+        else:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(format_prometheus(snapshot))
+            os.replace(tmp_path, self.path)
+
+
+class Stage:
+    __slots__ = ("metrics", "name", "since")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.since = 0.0
+
+    def __enter__(self):
+        self.since = time.perf_counter()
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.metrics.add_time(self.name, self.since)
+
+
+class Activity:
+    __slots__ = ("metrics",)
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __enter__(self):
+        self.metrics.active_since = time.perf_counter()
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.metrics.active = self.metrics.active_time()
+        self.metrics.active_since = None
+
+
+class NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def format_prometheus(snapshot):
+    lines = ["# TYPE populate_stage_seconds_total counter"]
+    for name, seconds in sorted(snapshot["stages"].items()):
+        lines.append(f'populate_stage_seconds_total{{stage="{name}"}} {seconds:.6f}')
+    lines.append("# TYPE populate_events_total counter")
+    for name, n in sorted(snapshot["counters"].items()):
+        lines.append(f'populate_events_total{{event="{name}"}} {n}')
+    for name, rate in sorted(snapshot["rates"].items()):
+        lines.append(f"# TYPE populate_{name} gauge")
+        lines.append(f"populate_{name} {rate:.3f}")
+    lines.append("# TYPE populate_elapsed_seconds gauge")
+    lines.append(f"populate_elapsed_seconds {snapshot['elapsed']:.3f}")
+    lines.append("# TYPE populate_active_seconds gauge")
+    lines.append(f"populate_active_seconds {snapshot['active']:.3f}")
+    return '\n'.join(lines) + '\n'
+
+
+class Sampler:
+    def __init__(self, path, interval=0.01, thread_id=None):
+        self.path = path
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.stacks = dict()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.writelines([f"{stack} {n}\n" for stack, n in sorted(self.stacks.items())])
+
+
+METRICS = Metrics()
+SAMPLER = [None]
+
+
+def setup():
+    METRICS.configure(get_env_default("METRICS_FILE", None),
+                      get_env_default("METRICS_FORMAT", "prom"),
+                      float(get_env_default("METRICS_INTERVAL", 5)))
+    profile_file = get_env_default("PROFILE_FILE", None)
+    if profile_file and SAMPLER[0] is None:
+        SAMPLER[0] = Sampler(profile_file, float(get_env_default("PROFILE_INTERVAL", 0.01)))
+        SAMPLER[0].start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    METRICS.dump()
+    if SAMPLER[0] is not None:
+        SAMPLER[0].stop()
+        SAMPLER[0] = None
@@ -1,27 +1,78 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from fs import Fs
-from db import Db, DbOperation
-from datafiles import get_file_encoding, get_file_size, format_file_size, strip, strip_arr
-from user import get_env, print_flush, panic, PANIC_DB_LOCKED, is_panic
+from db import Db, DbOperation, DbUnavailable, FailFast
+from asyncdb import DbPool, AsyncDbOperation
+from cache import load_cache
+from metrics import METRICS
+from datafiles import DataFile, read_file, save_schema, get_file_encoding, get_file_size, format_file_size, \
+    strip, strip_arr
+from genschema import SqlValueType, default_columns
+from projection import load_projection
+from records import RecordReader, load_rejected
+from reports import REPORT_BALL, ball_report_params, ball_report_query, ball_report_header
+from shards import ShardRouter, SHARD_KEYS, parse_shard_hosts, merge_partials
+from spool import Spool, SpoolSegment
+from throttle import load_throttle
+from user import get_env, get_env_default, print_flush, print_err, panic, PANIC_DB_LOCKED, PANIC_SPOOL_CORRUPTED, \
+    PANIC_SHARD_CONFIG, is_panic
+
+
+ENCODING_SAMPLE_SIZE = 1 << 20
 
 
 class Populate:
     ADVISORY_LOCK_ID = 54321234
 
     def __init__(self):
-        auth = dict(host=get_env("DB_HOST"),
-                    dbname=get_env("POSTGRES_DB"),
-                    user=get_env("POSTGRES_USER"),
-                    password=get_env("POSTGRES_PASSWORD"))
+        shard_hosts = parse_shard_hosts(get_env_default("SHARD_HOSTS", ""), get_env("POSTGRES_DB"))
+        if not shard_hosts:
+            shard_hosts = [dict(host=get_env("DB_HOST"), dbname=get_env("POSTGRES_DB"))]
+        self.auths = [dict(**shard_host,
+                           user=get_env("POSTGRES_USER"),
+                           password=get_env("POSTGRES_PASSWORD")) for shard_host in shard_hosts]
+        self.shard_key = get_env_default("SHARD_KEY", SHARD_KEYS[0]).lower()
+        if self.shard_key not in SHARD_KEYS:
+            panic(f"Unknown SHARD_KEY '{self.shard_key}', expected one of: {', '.join(SHARD_KEYS)}",
+                  PANIC_SHARD_CONFIG)
         retries = int(get_env("RETRIES"))
+        backoff_base = float(get_env_default("RETRY_BACKOFF_BASE", 0.5))
+        backoff_max = float(get_env_default("RETRY_BACKOFF_MAX", 30))
         self.target_table_name = get_env("TARGET_TABLE_NAME")
         self.aux_table_name = get_env("AUX_TABLE_NAME")
+        self.shard_map_table_name = get_env_default("SHARD_MAP_TABLE_NAME", f"{self.target_table_name}_SHARDS")
+        self.staging_table_name = get_env_default("STAGING_TABLE_NAME", f"{self.target_table_name}_STAGING")
+        self.types_table_name = get_env_default("TYPES_TABLE_NAME", f"{self.target_table_name}_TYPES")
+        self.load_table_name = self.target_table_name
+        self.inferred_types = None
+        self.persisted_types = dict()
+        self.cache = load_cache(self.target_table_name)
+        self.projection = load_projection()
+        self.max_record_lines = int(get_env_default("MAX_RECORD_LINES", 10))
+        self.max_record_bytes = int(get_env_default("MAX_RECORD_BYTES", 1 << 20))
+        self.reject_file = get_env_default("REJECT_FILE", "rejects.txt")
+        spool_folder = get_env_default("SPOOL_FOLDER", None)
+        self.spool = Spool(spool_folder) if spool_folder else None
+        self.spool_probe_interval = float(get_env_default("SPOOL_PROBE_INTERVAL", 10))
+        self.spool_slow_seconds = float(get_env_default("SPOOL_SLOW_SECONDS", 0))
+        self.spool_probed = 0.0
+        self.db_slow = False
+        self.throttle = load_throttle()
 
         self.fs = Fs()
-        self.db = Db(auth, retries)
+        self.shards = [Db(auth, retries, backoff_base, backoff_max) for auth in self.auths]
+        self.db = self.shards[0]
+        pool_size = int(get_env_default("DB_POOL_SIZE", 4))
+        self.pools = [DbPool(auth, retries, pool_size, backoff_base, backoff_max) for auth in self.auths]
+        self.router = ShardRouter(len(self.shards), self.shard_key)
+        self.shard_executor = ThreadPoolExecutor(len(self.shards)) if len(self.shards) > 1 else None
 
     def __enter__(self):
         self.fs.connect()
-        self.db.connect()
+        for db in self.shards:
+            db.connect()
         if not self.lock():
             panic("Db is locked by another instance, exiting.", PANIC_DB_LOCKED)
 
@@ -29,7 +80,12 @@ class Populate:
         if is_panic():
             return
         self.unlock()
-        self.db.disconnect()
+        for pool in self.pools:
+            pool.close()
+        if self.shard_executor is not None:
+            self.shard_executor.shutdown()
+        for db in self.shards:
+            db.disconnect()
         self.fs.disconnect()
 
     def lock(self):
@@ -41,18 +97,23 @@ class Populate:
                                                     "UNLOCK POPULATE")
 
     def revoke(self, target=True, aux=True):
-        if target:
-            DbOperation(self.db).revoke_privileges(self.target_table_name, "REVOKE TARGET TABLE PRIVILEGES")
-        if aux:
-            DbOperation(self.db).revoke_privileges(self.aux_table_name, "REVOKE AUX TABLE PRIVILEGES")
+        for db in self.shards:
+            if target:
+                DbOperation(db).revoke_privileges(self.target_table_name, "REVOKE TARGET TABLE PRIVILEGES")
+            if aux:
+                DbOperation(db).revoke_privileges(self.aux_table_name, "REVOKE AUX TABLE PRIVILEGES")
 
     def grant(self, target=True, aux=True):
-        if target:
-            DbOperation(self.db).grant_privileges(self.target_table_name, "GRANT TARGET TABLE PRIVILEGES")
-        if aux:
-            DbOperation(self.db).grant_privileges(self.aux_table_name, "GRANT AUX TABLE PRIVILEGES")
+        for db in self.shards:
+            if target:
+                DbOperation(db).grant_privileges(self.target_table_name, "GRANT TARGET TABLE PRIVILEGES")
+            if aux:
+                DbOperation(db).grant_privileges(self.aux_table_name, "GRANT AUX TABLE PRIVILEGES")
 
     def get_state(self):
+        if DbOperation(self.db).check_table_exists(self.staging_table_name, "CHECK EXISTS STAGING TABLE"):
+            return "staging"
+
         schema_loaded = self.fs.schema is not None
 
         if not schema_loaded:
@@ -74,34 +135,62 @@ class Populate:
                 return "clear"
 
     def drop_target(self):
-        DbOperation(self.db).drop_table(self.target_table_name, "DROP TARGET TABLE")
+        for db in self.shards:
+            DbOperation(db).drop_table_if_exists(self.target_table_name, "DROP TARGET TABLE")
+        DbOperation(self.db).drop_table_if_exists(self.shard_map_table_name, "DROP SHARD MAP TABLE")
+        self.cache.drop(DbOperation(self.db))
         return True
 
     def drop_aux(self):
-        DbOperation(self.db).drop_table(self.aux_table_name, "DROP AUX TABLE")
+        for db in self.shards:
+            DbOperation(db).drop_table_if_exists(self.aux_table_name, "DROP AUX TABLE")
+        self.cache.mark_loaded(DbOperation(self.db))
+        if self.spool is not None:
+            self.spool.clear()
 
     def do_query(self):
-        print_flush("Executing query for year 2019...")
-        year2019 = DbOperation(self.db).fetchall("EXAMPLE QUERY",
-                                                 f'SELECT Regname, MIN(PhysBall100) FROM "{self.target_table_name}" '
-                                                 f'WHERE PhysTestStatus=%s AND Year=%s GROUP BY Regname;',
-                                                 ("Зараховано", 2019))
-        print_flush("Saving result...")
-        lines = [["Region", "MinBall"]] + year2019
-        with open("query2019_result.csv", "w", encoding="utf-8") as f:
-            f.writelines([';'.join(line)+'\n' for line in lines])
-
-        print_flush("Executing query for year 2020...")
-        year2020 = DbOperation(self.db).fetchall("EXAMPLE QUERY",
-                                                 f'SELECT Regname, MIN(PhysBall100) FROM "{self.target_table_name}" '
-                                                 f'WHERE PhysTestStatus=%s AND Year=%s GROUP BY Regname;',
-                                                 ("Зараховано", 2020))
-        print_flush("Saving result...")
-        lines = [["Region", "MinBall"]] + year2020
-        with open("query2020_result.csv", "w", encoding="utf-8") as f:
-            f.writelines([';'.join(line)+'\n' for line in lines])
+        try:
+            params = ball_report_params(self.projection.filter_schema(self.fs.schema),
+                                        "Phys", "Зараховано", "Regname", "min")
+        except ValueError as e:
+            print_err(f"{e} in the loaded table, skipping the query.")
+            return
+        asyncio.run(self.do_report_async(params, [2019, 2020]))
+
+    async def do_report_async(self, params, years):
+        self.cache.ensure_tables(DbOperation(self.db))
+        self.db.commit()
+        print_flush(f"Executing query for years {', '.join(map(str, years))}...")
+        results = await asyncio.gather(*[self.fetch_report(params, year) for year in years])
+        for year, result in zip(years, results):
+            print_flush(f"Saving result for year {year}...")
+            lines = [ball_report_header(params)] + result
+            with open(f"query{year}_result.csv", "w", encoding="utf-8") as f:
+                f.writelines([';'.join(map(str, line))+'\n' for line in lines])
+
+    async def fetch_report(self, params, year):
+        key = self.cache.key(REPORT_BALL, params, year)
+        coordinator = AsyncDbOperation(self.pools[0])
+        version, result = await coordinator.transaction(lambda op: self.cache.lookup(op, key, year))
+        if result is not None:
+            METRICS.count("cache_hits")
+            return result
+        METRICS.count("cache_misses")
+        partials = await self.fetchall_shards(self.router.shards_of_file(year),
+                                              "BALL REPORT QUERY",
+                                              ball_report_query(self.target_table_name, params),
+                                              (params["status"], year))
+        result = merge_partials(partials, 1, [params["aggregate"]])
+        await coordinator.transaction(lambda op: self.cache.store(op, key, year, version, result))
+        return result
 
+    async def fetchall_shards(self, shards, name, command, data):
+        return await asyncio.gather(*[AsyncDbOperation(self.pools[shard]).fetchall(name, command, data)
+                                      for shard in shards])
 
+    async def transaction_shards(self, shards, operation):
+        return await asyncio.gather(*[AsyncDbOperation(self.pools[shard]).transaction(operation)
+                                      for shard in shards])
 
     @staticmethod
     def parse_sql_val(text, sql_type):
@@ -113,109 +202,469 @@ class Populate:
             return text
         elif sql_type == "CHARACTER VARYING":
             return text
+        elif sql_type == "TEXT":
+            return text
         return None
 
     def start(self):
-        column_types = DbOperation(self.db).get_table_column_types(self.target_table_name,
-                                                                   "SELECT TARGET TABLE COLUMNS")
+        with METRICS.activity():
+            self.load()
+        self.drop_aux()
+        return True
+
+    def load(self):
+        column_types = DbOperation(self.db).get_table_column_types(self.load_table_name,
+                                                                   "SELECT LOAD TABLE COLUMNS")
         columns = [c[0].upper() for c in column_types]
-        entries = DbOperation(self.db).fetchall(f'SELECT FROM AUX TABLE',
-                                                f'SELECT * FROM "{self.aux_table_name}" '
-                                                f'ORDER BY year, '
-                                                f'file_seek DESC '
-                                                f'LIMIT 1', ())
-        if len(entries) == 0:
-            self.drop_aux()
-            return True
-        file_name, year, file_seek, header_text = entries[0]
+        self.check_shard_map()
+        for db in self.shards:
+            db.commit()
+        shards = range(len(self.shards))
+        asyncio.run(self.transaction_shards(shards, lambda op: op.add_column_if_not_exists(
+            self.aux_table_name, "rejects", "BIGINT NOT NULL DEFAULT 0", "ADD AUX REJECTS COLUMN")))
+        self.drain()
+        files = dict()
+        aux_entries = asyncio.run(self.fetchall_shards(shards, "SELECT FROM AUX TABLE",
+                                                       f'SELECT file_name, year, file_seek, header, rejects '
+                                                       f'FROM "{self.aux_table_name}"', ()))
+        for shard, entries in enumerate(aux_entries):
+            for file_name, year, file_seek, header_text, rejects in entries:
+                file = files.setdefault(file_name, dict(year=year, header=header_text, seeks=dict(), rejects=dict()))
+                file["header"] = file["header"] or header_text
+                file["seeks"][shard] = file_seek
+                file["rejects"][shard] = rejects
+        self.cache.mark_loading(DbOperation(self.db), sorted({file["year"] for file in files.values()
+                                                              if file["year"] is not None}))
+        self.db.commit()
+        for file_name, file in sorted(files.items(), key=lambda kv: (kv[1]["year"] is None, kv[1]["year"] or 0,
+                                                                     -min(kv[1]["seeks"].values()))):
+            first_shard = min(file["seeks"], key=file["seeks"].get)
+            self.populate_file(columns, column_types, file_name, file["year"], file["seeks"], file["header"],
+                               file["rejects"][first_shard])
+        if self.spool is not None and self.spool.pending():
+            print_flush("Waiting for db to drain spooled batches...")
+        self.drain()
+
+    def check_shard_map(self):
+        configured = [(shard, auth["host"], auth.get("port"), auth["dbname"], self.shard_key)
+                      for shard, auth in enumerate(self.auths)]
+        if not DbOperation(self.db).check_table_exists(self.shard_map_table_name, "CHECK EXISTS SHARD MAP TABLE"):
+            if len(self.shards) == 1:
+                return
+            shard_map = []
+        else:
+            shard_map = [tuple(row) for row in DbOperation(self.db).fetchall(
+                "SELECT SHARD MAP",
+                f'SELECT shard, host, port, dbname, shard_key FROM "{self.shard_map_table_name}" ORDER BY shard', ())]
+        if len(self.shards) == 1:
+            matches = len(shard_map) == 1 and shard_map[0][4] == self.shard_key
+        else:
+            matches = shard_map == configured
+        if not matches:
+            populated = ', '.join(Populate.format_shard(*row) for row in shard_map) or "no shard map"
+            panic(f"Db was populated with shards [{populated}], but shards "
+                  f"[{', '.join(Populate.format_shard(*row) for row in configured)}] are configured, exiting.",
+                  PANIC_SHARD_CONFIG)
+
+    @staticmethod
+    def format_shard(shard, host, port, dbname, shard_key):
+        return f"{shard}: {host}{f':{port}' if port is not None else ''}/{dbname} by {shard_key}"
+
+    def populate_file(self, columns, column_types, file_name, year, shard_seeks, header_text, rejects):
+        file_seek = min(shard_seeks.values())
         file_size = get_file_size(file_name)
         print_flush(f"Populating from file '{file_name}' ({year}): ", end='')
-        with open(file_name, "r", encoding=get_file_encoding(file_name)) as file:
+        encoding = get_file_encoding(file_name)
+        rejected = load_rejected(self.reject_file, file_name, file_seek)
+        with DataFile(file_name) as data, open(self.reject_file, "ab") as reject_file:
+            def reject(offset, reason, record):
+                if offset in rejected:
+                    return
+                reject_file.write(f"{file_name};{offset};{reason};".encode() + record + b"\n")
+
+            reader = RecordReader(data.stream, file_seek, self.max_record_lines, self.max_record_bytes, reject)
+            reader.rejects = rejects
             if file_seek == 0:
-                header_text = file.readline().strip()
-                DbOperation(self.db).execute("UPDATE AUX HEADER",
-                                             f'UPDATE "{self.aux_table_name}" '
-                                             f'SET header = %s '
-                                             f'WHERE file_name = %s',
-                                             (header_text, file_name))
-            else:
-                header_text = DbOperation(self.db).fetchone("SELECT AUX HEADER",
-                                                            f'SELECT header FROM "{self.aux_table_name}" '
-                                                            f'WHERE file_name = %s',
-                                                            (file_name,))[0]
-                file.seek(file_seek)
+                header_text = reader.readline().decode(encoding).strip()
             header = strip_arr(header_text.split(';'))
             header = [h.upper() for h in header]
-            row_ind = [(header.index(c) if c in header else None) for c in columns]
+            row_ind = [(header.index(c) if c in header and self.projection.matches(c) else None) for c in columns]
+            maxsplit = max([ind for ind in row_ind if ind is not None], default=-1) + 1
+            year_ind = columns.index("YEAR")
+            outid_ind = columns.index("OUTID")
+            inferred = [self.inferred_types.get(c) if self.inferred_types is not None else None for c in columns]
             batch_size = 1000
             while True:
+                raw_seek = data.raw_tell()
                 print_flush(f"\rPopulating from file '{file_name}' ({year}): "
-                            f"{format_file_size(file_seek)} / {format_file_size(file_size)} "
-                            f"({file_seek / file_size:.2%})", end="")
+                            f"{format_file_size(raw_seek)} / {format_file_size(file_size)} "
+                            f"({raw_seek / file_size:.2%})", end="")
+                METRICS.tick()
+                self.throttle.before_batch()
                 end = False
                 rows = []
+                buckets = {shard: [] for shard in shard_seeks}
                 for i in range(batch_size):
-                    line = []
-                    prev_line_text = ""
-                    while True:
-                        line_text = prev_line_text + file.readline().strip()
-                        if not line_text:
-                            end = True
-                            break
-                        line = [strip(l) for l in line_text.rstrip().split(';')]
-                        if len(line) == len(header):
-                            break
-                        prev_line_text = line_text
-                    if end:
+                    start = reader.position
+                    line = reader.read_record(len(header), maxsplit)
+                    if line is None:
+                        end = True
                         break
+                    t = METRICS.clock()
                     row = []
                     for ind in range(len(columns)):
                         if row_ind[ind] is None:
                             row.append(None)
                         else:
-                            lv = line[row_ind[ind]]
+                            lv = line[row_ind[ind]].decode(encoding)
                             ct = column_types[ind][1]
                             p = Populate.parse_sql_val(lv, ct)
                             row.append(p)
-                    row[columns.index("YEAR")] = year
+                            if inferred[ind] is not None:
+                                inferred[ind].fit(SqlValueType(None, p))
+                    row[year_ind] = year
                     rows.append(row)
-
-                DbOperation(self.db).insert_many_into_table(self.target_table_name,
-                                                            columns,
-                                                            rows,
-                                                            "INSERT INTO TARGET TABLE")
+                    shard = self.router.shard_of_row(row[outid_ind], year)
+                    if shard in buckets and start >= shard_seeks[shard]:
+                        buckets[shard].append(row)
+                    METRICS.add_time("parse", t)
+                METRICS.count("rows", len(rows))
+                METRICS.count("batches")
 
                 if end:
+                    n_bytes = reader.position - file_seek
+                    METRICS.count("bytes", n_bytes)
                     print_flush(f"\r\x1b[1K\rPopulating from file '{file_name}' ({year}): {' ' * 35}", end="")
-                    print_flush(f"\r\x1b[1K\rPopulating from file '{file_name}' ({year}): done!")
-                    DbOperation(self.db).execute("DELETE FROM AUX TABLE",
-                                                 f'DELETE FROM "{self.aux_table_name}" '
-                                                 f'WHERE file_name = %s',
-                                                 (file_name,))
-                    self.commit()
-                    return self.start()
-
-                file_seek = file.tell()
-                DbOperation(self.db).execute("UPDATE AUX FILE SEEK",
-                                             f'UPDATE "{self.aux_table_name}" '
-                                             f'SET file_seek = %s '
-                                             f'WHERE file_name = %s',
-                                             (file_seek, file_name))
-                self.commit()
+                    rejects_str = f" ({reader.rejects} records rejected to '{self.reject_file}')" if reader.rejects else ""
+                    print_flush(f"\r\x1b[1K\rPopulating from file '{file_name}' ({year}): done!{rejects_str}")
+                    reject_file.flush()
+                    self.store_batch(columns, buckets, file_name, header_text, shard_seeks, None, reader.rejects,
+                                     n_bytes)
+                    METRICS.count("files")
+                    return
+
+                prev_file_seek, file_seek = file_seek, reader.position
+                METRICS.count("bytes", file_seek - prev_file_seek)
+                reject_file.flush()
+                self.store_batch(columns, buckets, file_name, header_text, shard_seeks, file_seek, reader.rejects,
+                                 file_seek - prev_file_seek)
+
+    def store_batch(self, columns, buckets, file_name, header_text, shard_seeks, file_seek, rejects, n_bytes):
+        targets = [shard for shard in buckets if file_seek is None or shard_seeks[shard] < file_seek]
+        failed = targets
+        if self.spool is None or self.db_available():
+            started = time.monotonic()
+            commit_seconds = self.write_shards(targets, columns, buckets, file_name, header_text, file_seek, rejects)
+            failed = [shard for shard, seconds in zip(targets, commit_seconds) if seconds is None]
+            if not failed:
+                self.throttle.after_batch(self.db, sum(len(rows) for rows in buckets.values()), n_bytes,
+                                          max(commit_seconds, default=0))
+            self.db_slow = 0 < self.spool_slow_seconds < time.monotonic() - started
+        if failed:
+            if not self.spool.pending():
+                print_err(f"\r\x1b[1K\rDb is unavailable or slow, spooling batches to '{self.spool.folder}'...")
+                self.spool_probed = time.monotonic()
+            with METRICS.stage("spool"):
+                for shard in failed:
+                    self.spool.write(SpoolSegment(shard, file_name, header_text, shard_seeks[shard], file_seek,
+                                                  rejects, columns, buckets[shard], self.dump_types()))
+            METRICS.count("spooled_batches")
+        if file_seek is not None:
+            for shard in targets:
+                shard_seeks[shard] = file_seek
+
+    def write_shards(self, shards, columns, buckets, file_name, header_text, file_seek, rejects):
+        def write(shard):
+            db = self.shards[shard]
+            try:
+                with FailFast(db, self.spool is not None):
+                    return self.write_batch(db, columns, buckets[shard], file_name, header_text, file_seek, rejects)
+            except DbUnavailable:
+                return None
+
+        if self.shard_executor is None or len(shards) < 2:
+            return [write(shard) for shard in shards]
+        return list(self.shard_executor.map(write, shards))
+
+    def db_available(self):
+        if not self.spool.pending():
+            return not self.db_slow
+        if time.monotonic() - self.spool_probed < self.spool_probe_interval:
+            return False
+        self.spool_probed = time.monotonic()
+        if not all(db.is_healthy() for db in self.shards):
+            return False
+        return self.drain(fail_fast=True)
+
+    def drain(self, fail_fast=False):
+        if self.spool is None or not self.spool.pending():
+            return True
+        segments = self.spool.segments()
+        print_err(f"\r\x1b[1K\rDraining {len(segments)} spooled batches from '{self.spool.folder}'...")
+        for path in segments:
+            try:
+                segment = self.spool.read(path)
+            except ValueError as e:
+                panic(f"{e}, exiting.", PANIC_SPOOL_CORRUPTED)
+            db = self.shards[segment.shard]
+            try:
+                with FailFast(db, fail_fast):
+                    self.drain_segment(db, path, segment)
+            except DbUnavailable:
+                print_err("\r\x1b[1K\rDb became unavailable while draining, spooling batches again...")
+                return False
+            self.spool.remove(path)
+        self.db_slow = False
+        return True
+
+    def drain_segment(self, db, path, segment):
+        entry = DbOperation(db).fetchone("SELECT AUX FILE SEEK",
+                                         f'SELECT file_seek FROM "{self.aux_table_name}" '
+                                         f'WHERE file_name = %s',
+                                         (segment.file_name,))
+        committed = entry is None or (segment.file_seek is not None and entry[0] >= segment.file_seek)
+        if committed:
+            return
+        self.throttle.before_batch()
+        if entry[0] != segment.start_seek:
+            panic(f"Spool segment '{path}' starts at {segment.start_seek}, but file '{segment.file_name}' "
+                  f"is committed up to {entry[0]} on shard {segment.shard}, exiting.", PANIC_SPOOL_CORRUPTED)
+        self.fit_types(segment.types)
+        with METRICS.stage("drain"):
+            commit_seconds = self.write_batch(db, segment.columns, segment.rows, segment.file_name,
+                                              segment.header_text, segment.file_seek, segment.rejects)
+        n_bytes = segment.file_seek - segment.start_seek if segment.file_seek is not None else 0
+        self.throttle.after_batch(db, len(segment.rows), n_bytes, commit_seconds)
+        METRICS.count("drained_batches")
+
+    def write_batch(self, db, columns, rows, file_name, header_text, file_seek, rejects):
+        while True:
+            generation = db.generation
+            with METRICS.stage("insert"):
+                DbOperation(db).insert_many_into_table(self.load_table_name,
+                                                       columns,
+                                                       rows,
+                                                       "INSERT INTO TARGET TABLE")
+            with METRICS.stage("aux_update"):
+                if file_seek is None:
+                    DbOperation(db).execute("DELETE FROM AUX TABLE",
+                                            f'DELETE FROM "{self.aux_table_name}" '
+                                            f'WHERE file_name = %s',
+                                            (file_name,))
+                else:
+                    DbOperation(db).execute("UPDATE AUX FILE SEEK",
+                                            f'UPDATE "{self.aux_table_name}" '
+                                            f'SET file_seek = %s, header = %s, rejects = %s '
+                                            f'WHERE file_name = %s',
+                                            (file_seek, header_text, rejects, file_name))
+                dirty_types = self.save_types(db)
+            if db.generation != generation:
+                db.rollback()
+            else:
+                commit_started = time.monotonic()
+                with METRICS.stage("commit"):
+                    db.commit()
+                commit_seconds = time.monotonic() - commit_started
+                if db.generation == generation or self.is_batch_committed(db, file_name, file_seek):
+                    self.persisted_types.setdefault(db, dict()).update(dirty_types)
+                    return commit_seconds
+            print_err(f"\r\x1b[1K\rConnection was re-established during the batch, "
+                      f"replaying it from the last committed checkpoint...")
+            METRICS.count("replays")
+
+    def is_batch_committed(self, db, file_name, file_seek):
+        entry = DbOperation(db).fetchone("SELECT AUX FILE SEEK",
+                                         f'SELECT file_seek FROM "{self.aux_table_name}" '
+                                         f'WHERE file_name = %s',
+                                         (file_name,))
+        if file_seek is None:
+            return entry is None
+        return entry is not None and entry[0] == file_seek
 
     def prepare(self):
-        DbOperation(self.db).create_table(self.target_table_name, self.fs.schema, "CREATE TARGET TABLE")
+        self.prepare_tables(self.target_table_name, self.projection.filter_schema(self.fs.schema))
+
+    def prepare_tables(self, table_name, table_schema, shard_tables=()):
+        if self.spool is not None:
+            self.spool.clear()
         aux_table_schema = {
             "file_name": "TEXT",
             "year": "SMALLINT",
             "file_seek": "BIGINT",
             "header": "TEXT",
+            "rejects": "BIGINT NOT NULL DEFAULT 0",
         }
-        DbOperation(self.db).create_table(self.aux_table_name, aux_table_schema, "CREATE AUX TABLE")
-        DbOperation(self.db).insert_many_into_table(self.aux_table_name,
-                                                    ["file_name", "year", "file_seek", "header"],
-                                                    [(file, year, 0, "") for file, year in self.fs.data_files],
-                                                    "INSERT INTO AUX TABLE")
+        for shard, db in enumerate(self.shards):
+            DbOperation(db).create_table(table_name, table_schema, "CREATE LOAD TABLE")
+            DbOperation(db).create_table(self.aux_table_name, aux_table_schema, "CREATE AUX TABLE")
+            for shard_table_name, shard_table_schema, operation_name in shard_tables:
+                DbOperation(db).create_table(shard_table_name, shard_table_schema, operation_name)
+            DbOperation(db).insert_many_into_table(self.aux_table_name,
+                                                   ["file_name", "year", "file_seek", "header"],
+                                                   [(file, year, 0, "") for file, year in self.fs.data_files
+                                                    if shard in self.router.shards_of_file(year)],
+                                                   "INSERT INTO AUX TABLE")
+            db.commit()
+        shard_map_table_schema = {
+            "shard": "SMALLINT",
+            "host": "TEXT",
+            "port": "INTEGER",
+            "dbname": "TEXT",
+            "shard_key": "TEXT",
+        }
+        DbOperation(self.db).create_table(self.shard_map_table_name, shard_map_table_schema, "CREATE SHARD MAP TABLE")
+        DbOperation(self.db).insert_many_into_table(self.shard_map_table_name,
+                                                    ["shard", "host", "port", "dbname", "shard_key"],
+                                                    [(shard, auth["host"], auth.get("port"), auth["dbname"],
+                                                      self.shard_key) for shard, auth in enumerate(self.auths)],
+                                                    "INSERT INTO SHARD MAP TABLE")
+        self.db.commit()
 
-    def commit(self):
+    def prepare_staged(self):
+        staging_schema = dict()
+        for i, (file_name, year) in enumerate(self.fs.data_files):
+            print_flush(f"\r\x1b[1K\rReading headers ({i+1}/{len(self.fs.data_files)}) '{file_name}'... ", end='')
+            header = strip_arr(read_file(file_name, Populate.read_header).split(';'))
+            for column_name in [h.upper() for h in header if self.projection.matches(h)]:
+                staging_schema.setdefault(column_name, "TEXT")
+        print_flush(f"\r\x1b[1K\rReading headers ({len(self.fs.data_files)} files, "
+                    f"{len(staging_schema)} columns)... done!")
+        staging_schema["YEAR"] = "SMALLINT"
+        self.fs.connect()
+        types_table_schema = {
+            "column_name": "TEXT PRIMARY KEY",
+            "sql_type": "SMALLINT",
+            "sql_len": "INTEGER",
+        }
+        self.prepare_tables(self.staging_table_name, staging_schema,
+                            [(self.types_table_name, types_table_schema, "CREATE TYPES TABLE")])
+
+    @staticmethod
+    def read_header(data):
+        header = data.text.readline()
+        data.text.read(ENCODING_SAMPLE_SIZE)
+        return header
+
+    def start_staged(self):
+        self.load_table_name = self.staging_table_name
+        self.load_types()
+        if all(DbOperation(db).check_table_exists(self.staging_table_name, "CHECK EXISTS STAGING TABLE")
+               for db in self.shards):
+            with METRICS.activity():
+                self.load()
+        self.finish_staged()
+        return True
+
+    def load_types(self):
+        column_types = DbOperation(self.db).get_table_column_types(self.staging_table_name,
+                                                                   "SELECT STAGING TABLE COLUMNS")
+        self.inferred_types = {c[0].upper(): SqlValueType(sql_type=SqlValueType.SQL_TYPE_SMALLINT)
+                               for c in column_types if c[1].upper() == "TEXT"}
+        for db in self.shards:
+            if not DbOperation(db).check_table_exists(self.types_table_name, "CHECK EXISTS TYPES TABLE"):
+                continue
+            persisted = self.persisted_types[db] = dict()
+            for column_name, sql_type, sql_len in DbOperation(db).fetchall("SELECT TYPES",
+                                                                           f'SELECT column_name, sql_type, sql_len '
+                                                                           f'FROM "{self.types_table_name}"', ()):
+                persisted[column_name] = (sql_type, sql_len)
+            self.fit_types(persisted)
+
+    def dump_types(self):
+        if self.inferred_types is None:
+            return None
+        return {column_name: (value_type.sql_type, value_type.sql_len)
+                for column_name, value_type in self.inferred_types.items()}
+
+    def fit_types(self, types):
+        if self.inferred_types is None or types is None:
+            return
+        for column_name, (sql_type, sql_len) in types.items():
+            value_type = SqlValueType(sql_type=sql_type)
+            value_type.sql_len = sql_len
+            self.inferred_types.setdefault(column_name, value_type).fit(value_type)
+
+    def save_types(self, db):
+        if self.inferred_types is None:
+            return dict()
+        persisted = self.persisted_types.get(db, dict())
+        dirty = {column_name: (value_type.sql_type, value_type.sql_len)
+                 for column_name, value_type in self.inferred_types.items()
+                 if persisted.get(column_name) != (value_type.sql_type, value_type.sql_len)}
+        if dirty:
+            DbOperation(db).execute_batch("UPSERT TYPES",
+                                          f'INSERT INTO "{self.types_table_name}" (column_name, sql_type, sql_len) '
+                                          f'VALUES (%s, %s, %s) ON CONFLICT (column_name) '
+                                          f'DO UPDATE SET sql_type = EXCLUDED.sql_type, sql_len = EXCLUDED.sql_len',
+                                          [(column_name, sql_type, sql_len)
+                                           for column_name, (sql_type, sql_len) in dirty.items()])
+        return dirty
+
+    def finish_staged(self):
+        columns = default_columns()
+        for column_name, value_type in self.inferred_types.items():
+            found = False
+            for column in columns:
+                if column_name == column[0].upper():
+                    column[1].fit(value_type)
+                    found = True
+                    break
+            if not found:
+                columns.append((column_name, value_type))
+        names = [column[0] for column in columns]
+        types = [column[1].dump() for column in columns]
+        casts = [Populate.cast_staged(name, value_type) if name in self.inferred_types else name
+                 for name, value_type in columns]
+
+        print_flush(f"Saving inferred schema ({len(columns)} columns) to folder '{self.fs.data_folder}'... ", end='')
+        self.persisted_types.setdefault(self.db, dict()).update(self.save_types(self.db))
         self.db.commit()
+        save_schema(self.fs.data_folder, names, types)
+        self.fs.connect()
+        print_flush("done!")
+
+        for shard in list(range(1, len(self.shards))) + [0]:
+            db = self.shards[shard]
+            if not DbOperation(db).check_table_exists(self.staging_table_name, "CHECK EXISTS STAGING TABLE"):
+                continue
+            print_flush(f"Casting staged rows into target table (shard {shard})... ", end='')
+            with METRICS.stage("cast"):
+                DbOperation(db).create_table(self.target_table_name, dict(zip(names, types)), "CREATE TARGET TABLE")
+                DbOperation(db).execute("CAST STAGING INTO TARGET TABLE",
+                                        f'INSERT INTO "{self.target_table_name}" ({", ".join(names)}) '
+                                        f'SELECT {", ".join(casts)} FROM "{self.staging_table_name}"', ())
+                DbOperation(db).drop_table(self.staging_table_name, "DROP STAGING TABLE")
+                DbOperation(db).drop_table(self.types_table_name, "DROP TYPES TABLE")
+                DbOperation(db).drop_table(self.aux_table_name, "DROP AUX TABLE")
+                if db is self.db:
+                    self.cache.mark_loaded(DbOperation(db))
+                db.commit()
+            print_flush("done!")
+        if self.spool is not None:
+            self.spool.clear()
+        self.load_table_name = self.target_table_name
+        self.inferred_types = None
+        self.persisted_types = dict()
+
+    @staticmethod
+    def cast_staged(name, value_type):
+        if value_type.sql_type == SqlValueType.SQL_TYPE_SMALLINT:
+            return f"NULLIF({name}, 'null')::SMALLINT"
+        return f"{name}::{value_type.dump()}"
+
+    def drop_staged(self):
+        for db in self.shards:
+            if not DbOperation(db).check_table_exists(self.staging_table_name, "CHECK EXISTS STAGING TABLE"):
+                DbOperation(db).drop_table_if_exists(self.target_table_name, "DROP TARGET TABLE")
+            DbOperation(db).drop_table_if_exists(self.staging_table_name, "DROP STAGING TABLE")
+            DbOperation(db).drop_table_if_exists(self.types_table_name, "DROP TYPES TABLE")
+            DbOperation(db).drop_table_if_exists(self.aux_table_name, "DROP AUX TABLE")
+        DbOperation(self.db).drop_table_if_exists(self.shard_map_table_name, "DROP SHARD MAP TABLE")
+        self.cache.drop(DbOperation(self.db))
+        if self.spool is not None:
+            self.spool.clear()
+        return True
+
+    def commit(self):
+        for db in self.shards:
+            db.commit()
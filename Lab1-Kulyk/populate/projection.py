@@ -0,0 +1,31 @@
+from fnmatch import fnmatchcase
+
+from user import get_env_default
+
+REQUIRED_COLUMNS = ["OUTID", "YEAR"]
+
+
+class Projection:
+    def __init__(self, include=None, exclude=None):
+        self.include = [p.upper() for p in include] if include else None
+        self.exclude = [p.upper() for p in exclude] if exclude else []
+
+    def matches(self, name):
+        name = name.upper()
+        if name in REQUIRED_COLUMNS:
+            return True
+        if self.include is not None and not any(fnmatchcase(name, p) for p in self.include):
+            return False
+        return not any(fnmatchcase(name, p) for p in self.exclude)
+
+    def filter_schema(self, schema):
+        return {name: sql_type for name, sql_type in schema.items() if self.matches(name)}
+
+
+def split_patterns(text):
+    return [p.strip() for p in text.split(',') if p.strip()]
+
+
+def load_projection():
+    return Projection(split_patterns(get_env_default("COLUMNS_INCLUDE", "")),
+                      split_patterns(get_env_default("COLUMNS_EXCLUDE", "")))
@@ -0,0 +1,116 @@
+import mmap
+import os
+
+from metrics import METRICS
+
+
+class RecordReader:
+    def __init__(self, stream, offset=0, max_lines=10, max_bytes=1 << 20, reject=None):
+        self.stream = stream
+        self.offset = offset
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.reject = reject
+        self.rejects = 0
+        self.pending = None
+        if offset:
+            stream.seek(offset)
+
+    @property
+    def position(self):
+        if self.pending is None:
+            return self.offset
+        return self.offset - len(self.pending)
+
+    def readline(self):
+        limit = self.max_bytes + 1
+        if isinstance(self.stream, mmap.mmap):
+            pos = self.stream.tell()
+            end = self.stream.find(b"\n", pos, pos + limit)
+            line = self.stream.read(end + 1 - pos if end >= 0 else limit)
+        else:
+            line = self.stream.readline(limit)
+        self.offset += len(line)
+        return line
+
+    def overlong(self, line):
+        return len(line) > self.max_bytes and not line.endswith(b"\n")
+
+    def skip_line(self):
+        while True:
+            line = self.readline()
+            if not self.overlong(line):
+                return
+
+    def next_line(self):
+        if self.pending is not None:
+            line, self.pending = self.pending, None
+            return line
+        return self.readline()
+
+    def quarantine(self, offset, reason, record):
+        self.rejects += 1
+        METRICS.count("rejects")
+        if self.reject is not None:
+            self.reject(offset, reason, record)
+
+    def read_record(self, field_count, maxsplit=-1):
+        while True:
+            start = self.position
+            record = b""
+            lines = 0
+            while True:
+                t = METRICS.clock()
+                raw_line = self.next_line()
+                METRICS.add_time("read", t)
+                if not raw_line:
+                    if record:
+                        self.quarantine(start, "truncated record at end of file", record)
+                    return None
+                if self.overlong(raw_line):
+                    self.skip_line()
+                    self.quarantine(start, f"line exceeds {self.max_bytes} bytes", record + raw_line)
+                    break
+                line = raw_line.strip()
+                if not line and not record:
+                    start = self.position
+                    continue
+                t = METRICS.clock()
+                candidate = record + line
+                lines += 1
+                fields_found = candidate.count(b';') + 1
+                fields = candidate.split(b';', maxsplit) if fields_found == field_count else None
+                METRICS.add_time("tokenise", t)
+                if fields is not None:
+                    return fields
+                if fields_found > field_count:
+                    reason = f"too many fields ({fields_found}/{field_count})"
+                elif lines >= self.max_lines:
+                    reason = f"record spans more than {self.max_lines} lines"
+                elif len(candidate) > self.max_bytes:
+                    reason = f"record exceeds {self.max_bytes} bytes"
+                else:
+                    record = candidate
+                    continue
+                if record:
+                    self.pending = raw_line
+                    self.quarantine(start, f"incomplete record ({record.count(b';') + 1}/{field_count} fields)",
+                                    record)
+                else:
+                    self.quarantine(start, reason, candidate)
+                break
+
+
+def load_rejected(path, file_name, since):
+    rejected = set()
+    if not os.path.exists(path):
+        return rejected
+    prefix = f"{file_name};".encode()
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.startswith(prefix):
+                continue
+            offset = line[len(prefix):].split(b";", 1)[0]
+            if offset.isdigit() and int(offset) >= since:
+                rejected.add(int(offset))
+    return rejected
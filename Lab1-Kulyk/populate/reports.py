@@ -0,0 +1,27 @@
+REPORT_BALL = "ball"
+REPORT_AGGREGATES = ["min", "max", "count", "sum"]
+REPORT_LABELS = {"REGNAME": "Region"}
+
+
+def ball_report_params(schema, subject, status, group_by="Regname", aggregate="min"):
+    columns = [name.upper() for name in schema]
+    subject = subject.strip().upper()
+    group_by = group_by.strip().upper()
+    aggregate = aggregate.strip().lower()
+    for column in [f"{subject}BALL100", f"{subject}TESTSTATUS", group_by]:
+        if column not in columns:
+            raise ValueError(f"Unknown report column '{column}'")
+    if aggregate not in REPORT_AGGREGATES:
+        raise ValueError(f"Unknown report aggregate '{aggregate}'")
+    return dict(subject=subject, status=status.strip(), group_by=group_by, aggregate=aggregate)
+
+
+def ball_report_query(table_name, params):
+    return (f'SELECT {params["group_by"]}, {params["aggregate"].upper()}({params["subject"]}Ball100) '
+            f'FROM "{table_name}" '
+            f'WHERE {params["subject"]}TestStatus=%s AND Year=%s GROUP BY {params["group_by"]};')
+
+
+def ball_report_header(params):
+    return [REPORT_LABELS.get(params["group_by"], params["group_by"].capitalize()),
+            f'{params["aggregate"].capitalize()}Ball']
@@ -0,0 +1,63 @@
+import zlib
+
+SHARD_KEY_OUTID = "outid"
+SHARD_KEY_YEAR = "year"
+SHARD_KEYS = [SHARD_KEY_OUTID, SHARD_KEY_YEAR]
+
+
+def parse_shard_hosts(text, default_dbname):
+    shards = []
+    for entry in [e.strip() for e in text.split(',') if e.strip()]:
+        host, _, dbname = entry.partition('/')
+        host, _, port = host.partition(':')
+        shard = dict(host=host, dbname=dbname or default_dbname)
+        if port:
+            shard["port"] = int(port)
+        shards.append(shard)
+    return shards
+
+
+class ShardRouter:
+    def __init__(self, shard_count, shard_key=SHARD_KEY_OUTID):
+        self.shard_count = shard_count
+        self.shard_key = shard_key
+
+    def shard_of_year(self, year):
+        return (year or 0) % self.shard_count
+
+    def shards_of_file(self, year):
+        if self.shard_count == 1:
+            return [0]
+        if self.shard_key == SHARD_KEY_YEAR:
+            return [self.shard_of_year(year)]
+        return list(range(self.shard_count))
+
+    def shard_of_row(self, outid, year):
+        if self.shard_count == 1:
+            return 0
+        if self.shard_key == SHARD_KEY_YEAR:
+            return self.shard_of_year(year)
+        return zlib.crc32(str(outid).encode()) % self.shard_count
+
+
+def merge_partials(partials, key_len, aggregates):
+    merged = dict()
+    for rows in partials:
+        for row in rows:
+            key, values = tuple(row[:key_len]), row[key_len:]
+            if key not in merged:
+                merged[key] = list(values)
+                continue
+            acc = merged[key]
+            for i, (aggregate, value) in enumerate(zip(aggregates, values)):
+                if value is None:
+                    continue
+                if acc[i] is None:
+                    acc[i] = value
+                elif aggregate == "min":
+                    acc[i] = min(acc[i], value)
+                elif aggregate == "max":
+                    acc[i] = max(acc[i], value)
+                elif aggregate in ("count", "sum"):
+                    acc[i] += value
+    return [list(key) + values for key, values in sorted(merged.items(), key=lambda kv: str(kv[0]))]
@@ -0,0 +1,157 @@
+import math
+
+HLL_PRECISION = 12
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+NULL_VALUES = ["", "null"]
+SUMMARY_CAPACITY = 256
+
+
+class HyperLogLog:
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        x = hash(value) & HASH_MASK
+        ind = x >> (HASH_BITS - self.precision)
+        w = x & ((1 << (HASH_BITS - self.precision)) - 1)
+        rank = HASH_BITS - self.precision - w.bit_length() + 1
+        if rank > self.registers[ind]:
+            self.registers[ind] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if e <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return e
+
+
+class SpaceSaving:
+    def __init__(self, k, capacity=SUMMARY_CAPACITY):
+        self.k = k
+        self.capacity = max(2 * k, capacity)
+        self.counts = dict()
+        self.errors = dict()
+        self.buckets = dict()
+        self.min_count = 0
+
+    def hit(self, value):
+        count = self.counts.get(value)
+        if count is None:
+            return False
+        bucket = self.buckets[count]
+        del bucket[value]
+        if not bucket:
+            del self.buckets[count]
+            if count == self.min_count:
+                self.min_count = count + 1
+        self.counts[value] = count + 1
+        self.buckets.setdefault(count + 1, dict())[value] = None
+        return True
+
+    def insert(self, value):
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error = self.min_count
+            bucket = self.buckets[error]
+            victim = next(iter(bucket))
+            del bucket[victim]
+            if not bucket:
+                del self.buckets[error]
+            del self.counts[victim]
+            del self.errors[victim]
+        self.counts[value] = error + 1
+        self.errors[value] = error
+        self.buckets.setdefault(error + 1, dict())[value] = None
+        if error == 0:
+            self.min_count = 1
+        elif error not in self.buckets:
+            self.min_count = error + 1
+
+    def add(self, value):
+        if not self.hit(value):
+            self.insert(value)
+
+    def floor(self):
+        return self.min_count if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        floor, other_floor = self.floor(), other.floor()
+        counts = dict()
+        errors = dict()
+        for value in set(self.counts) | set(other.counts):
+            counts[value] = self.counts.get(value, floor) + other.counts.get(value, other_floor)
+            errors[value] = self.errors.get(value, floor) + other.errors.get(value, other_floor)
+        kept = sorted(counts, key=counts.get, reverse=True)[:self.capacity]
+        self.counts = {value: counts[value] for value in kept}
+        self.errors = {value: errors[value] for value in kept}
+        self.buckets = dict()
+        for value, count in self.counts.items():
+            self.buckets.setdefault(count, dict())[value] = None
+        self.min_count = min(self.buckets, default=0)
+
+    def top(self):
+        items = sorted(self.counts.items(), key=lambda kv: -kv[1])[:self.k]
+        return [[value, n, self.errors[value]] for value, n in items if n - self.errors[value] > 1]
+
+
+class ColumnStats:
+    def __init__(self, top_k):
+        self.count = 0
+        self.nulls = 0
+        self.min_text = None
+        self.max_text = None
+        self.min_num = None
+        self.max_num = None
+        self.text_seen = False
+        self.hll = HyperLogLog()
+        self.top_k = SpaceSaving(top_k)
+
+    def add(self, value, num=None):
+        self.count += 1
+        if value in NULL_VALUES:
+            self.nulls += 1
+            return
+        if self.top_k.hit(value):
+            return
+        self.hll.add(value)
+        self.top_k.insert(value)
+        if num is not None:
+            if self.min_num is None or num < self.min_num:
+                self.min_num = num
+            if self.max_num is None or num > self.max_num:
+                self.max_num = num
+        else:
+            self.text_seen = True
+        if self.min_text is None or value < self.min_text:
+            self.min_text = value
+        if self.max_text is None or value > self.max_text:
+            self.max_text = value
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        for name, pick in [("min_text", min), ("max_text", max), ("min_num", min), ("max_num", max)]:
+            values = [v for v in (getattr(self, name), getattr(other, name)) if v is not None]
+            setattr(self, name, pick(values) if values else None)
+        self.text_seen = self.text_seen or other.text_seen
+        self.hll.merge(other.hll)
+        self.top_k.merge(other.top_k)
+
+    def dump(self):
+        numeric = not self.text_seen and self.min_num is not None
+        return {
+            "count": self.count,
+            "nulls": self.nulls,
+            "min": self.min_num if numeric else self.min_text,
+            "max": self.max_num if numeric else self.max_text,
+            "distinct": round(self.hll.estimate()),
+            "top": self.top_k.top(),
+        }
@@ -0,0 +1,76 @@
+import os
+import pickle
+import struct
+import zlib
+
+SEGMENT_MAGIC = b"ZNOSPOOL1"
+SEGMENT_HEADER = struct.Struct("<II")
+SEGMENT_EXT = ".seg"
+
+
+class SpoolSegment:
+    def __init__(self, shard, file_name, header_text, start_seek, file_seek, rejects, columns, rows, types=None):
+        self.shard = shard
+        self.file_name = file_name
+        self.header_text = header_text
+        self.start_seek = start_seek
+        self.file_seek = file_seek
+        self.rejects = rejects
+        self.columns = columns
+        self.rows = rows
+        self.types = types
+
+
+class Spool:
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        segments = self.segments()
+        self.count = len(segments)
+        self.next_index = int(os.path.basename(segments[-1])[:-len(SEGMENT_EXT)]) + 1 if segments else 0
+
+    def segments(self):
+        return sorted(os.path.join(self.folder, f) for f in os.listdir(self.folder) if f.endswith(SEGMENT_EXT))
+
+    def pending(self):
+        return self.count > 0
+
+    def write(self, segment):
+        meta = pickle.dumps((segment.file_name, segment.header_text, segment.start_seek,
+                             segment.file_seek, segment.rejects, segment.columns, segment.shard, segment.types),
+                            pickle.HIGHEST_PROTOCOL)
+        payload = zlib.compress(pickle.dumps(segment.rows, pickle.HIGHEST_PROTOCOL), 1)
+        path = os.path.join(self.folder, f"{self.next_index:010d}{SEGMENT_EXT}")
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(SEGMENT_MAGIC + SEGMENT_HEADER.pack(len(meta), len(payload)) + meta + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        self.next_index += 1
+        self.count += 1
+        return path
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        start = len(SEGMENT_MAGIC) + SEGMENT_HEADER.size
+        if not data.startswith(SEGMENT_MAGIC) or len(data) < start:
+            raise ValueError(f"Spool segment '{path}' is corrupted")
+        meta_len, payload_len = SEGMENT_HEADER.unpack_from(data, len(SEGMENT_MAGIC))
+        if len(data) != start + meta_len + payload_len:
+            raise ValueError(f"Spool segment '{path}' is truncated")
+        meta = pickle.loads(data[start:start + meta_len])
+        file_name, header_text, start_seek, file_seek, rejects, columns = meta[:6]
+        shard = meta[6] if len(meta) > 6 else 0
+        types = meta[7] if len(meta) > 7 else None
+        rows = pickle.loads(zlib.decompress(data[start + meta_len:]))
+        return SpoolSegment(shard, file_name, header_text, start_seek, file_seek, rejects, columns, rows, types)
+
+    def remove(self, path):
+        os.remove(path)
+        self.count -= 1
+
+    def clear(self):
+        for path in self.segments():
+            self.remove(path)
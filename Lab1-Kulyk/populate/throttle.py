@@ -0,0 +1,75 @@
+import time
+
+from db import DbOperation
+from metrics import METRICS
+from user import get_env_default
+
+MIN_FACTOR = 0.05
+FACTOR_STEP = 0.05
+
+
+class Throttle:
+    def __init__(self, rows_per_second=0, bytes_per_second=0, max_commit_latency=0,
+                 max_active_queries=0, max_replication_lag=0, check_interval=5):
+        self.rows_per_second = rows_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_commit_latency = max_commit_latency
+        self.max_active_queries = max_active_queries
+        self.max_replication_lag = max_replication_lag
+        self.check_interval = check_interval
+        self.enabled = any([rows_per_second, bytes_per_second, max_commit_latency,
+                            max_active_queries, max_replication_lag])
+        self.factor = 1.0
+        self.batch_started = time.monotonic()
+        self.last_check = 0.0
+
+    def server_overloaded(self, db):
+        if self.max_active_queries:
+            active = DbOperation(db).fetchone("THROTTLE ACTIVE QUERIES",
+                                              "SELECT count(*) FROM pg_stat_activity "
+                                              "WHERE state = 'active' AND pid <> pg_backend_pid()", ())[0]
+            if active > self.max_active_queries:
+                return True
+        if self.max_replication_lag:
+            lag = DbOperation(db).fetchone("THROTTLE REPLICATION LAG",
+                                           "SELECT COALESCE(MAX(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)), 0) "
+                                           "FROM pg_stat_replication", ())[0]
+            if lag > self.max_replication_lag:
+                return True
+        return False
+
+    def before_batch(self):
+        self.batch_started = time.monotonic()
+
+    def after_batch(self, db, rows, n_bytes, commit_seconds):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        overloaded = 0 < self.max_commit_latency < commit_seconds
+        if not overloaded and now - self.last_check >= self.check_interval:
+            self.last_check = now
+            overloaded = self.server_overloaded(db)
+        if overloaded:
+            self.factor = max(MIN_FACTOR, self.factor / 2)
+        else:
+            self.factor = min(1.0, self.factor + FACTOR_STEP)
+
+        elapsed = now - self.batch_started
+        target = elapsed / self.factor
+        if self.rows_per_second:
+            target = max(target, rows / (self.rows_per_second * self.factor))
+        if self.bytes_per_second:
+            target = max(target, n_bytes / (self.bytes_per_second * self.factor))
+        if target > elapsed:
+            with METRICS.stage("throttle"):
+                time.sleep(target - elapsed)
+        self.batch_started = time.monotonic()
+
+
+def load_throttle():
+    return Throttle(float(get_env_default("THROTTLE_ROWS_PER_SECOND", 0)),
+                    float(get_env_default("THROTTLE_MB_PER_SECOND", 0)) * 1024 * 1024,
+                    float(get_env_default("THROTTLE_MAX_COMMIT_LATENCY", 0)),
+                    int(get_env_default("THROTTLE_MAX_ACTIVE_QUERIES", 0)),
+                    float(get_env_default("THROTTLE_MAX_REPLICATION_LAG_MB", 0)) * 1024 * 1024,
+                    float(get_env_default("THROTTLE_CHECK_INTERVAL", 5)))
@@ -31,6 +31,13 @@ def get_env(var_name):
     return value
 
 
+def get_env_default(var_name, default):
+    value = os.environ.get(var_name, env_vars.get(var_name))
+    if value is None or value == "":
+        return default
+    return value
+
+
 def print_err(message):
     print_flush(message, file=sys.stderr)
 
@@ -47,6 +54,8 @@ PANIC_DATA_FOLDER_DOESNT_EXIST = 2
 PANIC_DB_LOCKED = 3
 PANIC_DB_ERROR_OCCURRED = 4
 PANIC_DB_RETRIED_ERROR = 5
+PANIC_SPOOL_CORRUPTED = 6
+PANIC_SHARD_CONFIG = 7
 
 
 def panic(message, exitcode):